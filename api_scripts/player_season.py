@@ -1,10 +1,16 @@
 import os
-import time
 import json
+import time
+import functools
+from itertools import islice
 import duckdb
+import ijson
 import requests
-import pandas as pd
-from pandas import json_normalize
+import pyarrow as pa
+import pyarrow.compute as pc
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
 
 # -------------------------
 # CONFIG
@@ -29,22 +35,38 @@ END_RANGE    = None          # e.g. "2025-03-31T23:59:59"
 DUCKDB_PATH = "/Users/dominicparolin/Code/dommyhoops/backend/cbb_data.duckdb"
 RAW_TABLE   = "player_stats_season_raw_2025"
 FLAT_TABLE  = "player_stats_season_flat_2025"
+WRITE_RAW   = False          # flat table already carries every field; raw is optional
 
 MAX_RETRIES = 5
 TIMEOUT_SEC = 60
+BATCH_SIZE  = 5_000          # records parsed and appended per batch
+
+# one keep-alive session so retries reuse the TCP/TLS connection;
+# urllib3 handles 429/5xx backoff and honours Retry-After
+RETRY = Retry(
+    total=MAX_RETRIES,
+    backoff_factor=0.6,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET",),
+    respect_retry_after_header=True,
+)
+
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=RETRY))
 
 # -------------------------
 # HELPERS
 # -------------------------
+_NORM_TABLE = str.maketrans({" ": "_", ".": "_", "-": "_"})
+
+@functools.lru_cache(maxsize=4096)
 def _norm(name: str) -> str:
-    return (
-        str(name)
-        .strip()
-        .replace(" ", "_")
-        .replace(".", "_")
-        .replace("-", "_")
-        .lower()
-    )
+    return str(name).strip().translate(_NORM_TABLE).lower()
+
+def _quote(name: str) -> str:
+    # API keys can be reserved words ("order", "to") or start with a digit
+    return '"' + name.replace('"', '""') + '"'
 
 def backoff(attempt: int):
     time.sleep((attempt + 1) * 0.6)
@@ -52,6 +74,7 @@ def backoff(attempt: int):
 def fetch_player_stats(season: int):
     """
     GET /stats/player/season with optional filters.
+    Streams the response and yields records as they are parsed.
     """
     params = {"season": season}
 
@@ -66,58 +89,137 @@ def fetch_player_stats(season: int):
     if END_RANGE:
         params["endDateRange"] = END_RANGE
 
+    # urllib3's Retry only covers the request and headers; a connection that
+    # drops while the body streams is retried here, skipping the records
+    # already yielded (the API returns rows in a stable order)
+    yielded = 0
     for attempt in range(MAX_RETRIES + 1):
         try:
-            r = requests.get(API_URL, headers=HEADERS, params=params, timeout=TIMEOUT_SEC)
-            if r.status_code == 200:
-                return r.json()
-            if r.status_code in (429, 500, 502, 503, 504):
-                if attempt == MAX_RETRIES:
-                    raise RuntimeError(f"HTTP {r.status_code} after retries: {r.text[:200]}")
-                backoff(attempt)
-                continue
-            r.raise_for_status()
-        except requests.RequestException:
+            with SESSION.get(API_URL, params=params, timeout=TIMEOUT_SEC, stream=True) as r:
+                r.raise_for_status()
+                r.raw.decode_content = True  # let urllib3 undo gzip before ijson reads
+                records = ijson.items(r.raw, "item", use_float=True)
+                for record in islice(records, yielded, None):
+                    yield record
+                    yielded += 1
+            return
+        except (ProtocolError, ReadTimeoutError, requests.exceptions.ChunkedEncodingError):
             if attempt == MAX_RETRIES:
                 raise
             backoff(attempt)
-    return []
+
+def batched(records, size: int):
+    it = iter(records)
+    while batch := list(islice(it, size)):
+        yield batch
 
 # -------------------------
 # TRANSFORMS
 # -------------------------
-def to_raw_df(records):
+def _flatten(d, prefix="", out=None, depth=0, max_depth=2, sep="."):
     """
-    Direct DataFrame version. Lists and dicts stay as JSON strings.
+    Walk nested dicts into one level of "a.b.c" keys, like json_normalize(max_level=2).
     """
-    if not records:
-        return pd.DataFrame()
+    if out is None:
+        out = {}
+    for k, v in d.items():
+        key = prefix + k
+        if isinstance(v, dict) and depth < max_depth:
+            _flatten(v, key + sep, out, depth + 1, max_depth, sep)
+        else:
+            out[key] = v
+    return out
+
+# Arrow type for each set of Python types a column can hold;
+# keys that are null in every row stay NULL-typed so they never decide a column type
+_FLAT_TYPES = {
+    frozenset(): pa.null(),
+    frozenset([bool]): pa.bool_(),
+    frozenset([int]): pa.int64(),
+    frozenset([float]): pa.float64(),
+    frozenset([int, float]): pa.float64(),
+    frozenset([str]): pa.string(),
+}
 
-    df = pd.DataFrame(records)
+def _to_str(v):
+    if v is None or isinstance(v, str):
+        return v
+    if isinstance(v, (list, dict, bool)):
+        # compact, to match DuckDB's to_json() output in the same columns
+        return json.dumps(v, separators=(",", ":"))
+    return str(v)
 
-    # convert any list/dict columns to JSON strings
-    for col in df.columns:
-        df[col] = df[col].apply(
-            lambda x: json.dumps(x) if isinstance(x, (list, dict)) else x
-        )
+def _arrow_schema(rows):
+    """
+    Arrow schema from the value types seen per key, in first-seen key order,
+    plus the keys whose values must be stringified to fit it.
+    Lists and leftover dicts are handed to Arrow to infer; mixed scalar
+    types (e.g. a stat that is sometimes "-") become strings.
+    """
+    seen = {}
+    for r in rows:
+        for k, v in r.items():
+            types = seen.setdefault(k, set())
+            if v is not None:
+                types.add(type(v))
+
+    fields = []
+    as_str = set()
+    for k, types in seen.items():
+        typ = _FLAT_TYPES.get(frozenset(types))
+        if typ is None and types <= {list, dict}:
+            try:
+                typ = pa.array([r.get(k) for r in rows]).type
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                typ = None
+        if typ is None:
+            typ = pa.string()
+            as_str.add(k)
+        fields.append((k, typ))
+    return pa.schema(fields), as_str
+
+def _to_arrow(rows):
+    """
+    Arrow table over the union of keys in rows (mutated in place when a
+    column has to be stringified), with normalized column names.
+    """
+    schema, as_str = _arrow_schema(rows)
+    for r in rows:
+        for k in as_str & r.keys():
+            r[k] = _to_str(r[k])
 
-    df.columns = [_norm(c) for c in df.columns]
-    return df
+    tbl = pa.Table.from_pylist(rows, schema=schema)
+    return tbl.rename_columns([_norm(c) for c in tbl.column_names])
+
+def to_raw_df(records):
+    """
+    Arrow table built straight from the records. Lists and dicts stay
+    nested and land in DuckDB as LIST/STRUCT columns.
+    """
+    if not records:
+        return pa.table({})
+
+    # max_depth=0 copies each record without flattening, so the caller's dicts stay untouched
+    return _to_arrow([_flatten(r, max_depth=0) for r in records])
 
 def to_flat_df(records, sep="."):
     """
-    Flatten nested dicts into top level columns.
+    Flatten nested dicts into top level columns of an Arrow table.
     """
     if not records:
-        return pd.DataFrame()
+        return pa.table({})
 
-    flat = json_normalize(records, sep=sep, max_level=2)
-    flat.columns = [_norm(c) for c in flat.columns]
+    flat = _to_arrow([_flatten(r, sep=sep) for r in records])
 
     # optional unique key if these exist
-    if all(c in flat.columns for c in ["playerid", "season"]):
-        flat["unique_key"] = (
-            flat["playerid"].astype("string") + "-" + flat["season"].astype("string")
+    if all(c in flat.column_names for c in ["playerid", "season"]):
+        flat = flat.append_column(
+            "unique_key",
+            pc.binary_join_element_wise(
+                pc.cast(flat["playerid"], pa.string()),
+                pc.cast(flat["season"], pa.string()),
+                "-",
+            ),
         )
 
     return flat
@@ -125,73 +227,146 @@ def to_flat_df(records, sep="."):
 # -------------------------
 # DYNAMIC APPEND (same as roster script)
 # -------------------------
-def append_df(con: duckdb.DuckDBPyConnection, table: str, df: pd.DataFrame):
-    if df.empty:
-        return
+# column comment marking a placeholder column created from an all-null batch
+UNTYPED_COMMENT = "untyped: created from an all-null batch"
 
-    df = df.copy()
-    df.columns = [_norm(c) for c in df.columns]
-
-    exists = con.execute(
-        f"SELECT COUNT(*)>0 FROM information_schema.tables WHERE table_name = '{_norm(table)}'"
-    ).fetchone()[0]
-    if not exists:
-        con.register("tmp_df_init", df.head(0))
-        con.execute(f"CREATE TABLE {_norm(table)} AS SELECT * FROM tmp_df_init")
-        con.unregister("tmp_df_init")
+def append_df(con: duckdb.DuckDBPyConnection, table: str, df):
+    """
+    Append an Arrow table (or any frame pa.table accepts, e.g. pandas or polars),
+    adding and widening columns as needed.
+    """
+    if not isinstance(df, pa.Table):
+        df = pa.table(df)
+    if df.num_rows == 0:
+        return
 
-    info = con.execute(f"PRAGMA table_info('{_norm(table)}')").fetchall()
-    table_types = {_norm(row[1]): row[2].upper() for row in info}
+    tbl = _norm(table)
+    new_cols = [_norm(c) for c in df.column_names]
+    df = df.rename_columns(new_cols)
+    con.register("tmp_arrow", df)
+
+    # let DuckDB map the Arrow schema; all-null columns and lists that were
+    # empty in every row are kept as NULL (DESCRIBE would report INTEGER / INTEGER[])
+    null_cols = {
+        f.name for f in df.schema
+        if pa.types.is_null(f.type)
+        or (pa.types.is_list(f.type) and pa.types.is_null(f.type.value_type))
+    }
+    df_types = {
+        row[0]: "NULL" if row[0] in null_cols else row[1]
+        for row in con.execute("DESCRIBE SELECT * FROM tmp_arrow").fetchall()
+    }
+
+    def col_type(duck_type: str) -> str:
+        # an all-null column only picks the type when the column is new
+        return "VARCHAR" if duck_type == "NULL" else duck_type
+
+    # one metadata query covers "does it exist", "what columns" and which
+    # columns are still untyped placeholders
+    info = con.execute(
+        "SELECT column_name, data_type, comment FROM duckdb_columns() "
+        "WHERE table_name = ? ORDER BY column_index",
+        [tbl],
+    ).fetchall()
+
+    # DuckDB allows one action per ALTER, so schema changes are collected
+    # and sent as a single multi-statement batch
+    ddl = []
+
+    def mark_untyped(col: str):
+        ddl.append(f"COMMENT ON COLUMN {tbl}.{_quote(col)} IS '{UNTYPED_COMMENT}'")
+
+    if not info:
+        info = [(c, col_type(t), None) for c, t in df_types.items()]
+        cols_sql = ", ".join(f"{_quote(c)} {t}" for c, t, _ in info)
+        con.execute(f"CREATE TABLE {tbl} ({cols_sql})")
+        untyped = {c for c, t in df_types.items() if t == "NULL"}
+        for col in untyped:
+            mark_untyped(col)
+    else:
+        untyped = {_norm(name) for name, _, comment in info if comment == UNTYPED_COMMENT}
+
+    # types are compared verbatim: upper-casing would also upper-case struct field names
+    table_types = {_norm(name): dtype for name, dtype, _ in info}
     table_cols = list(table_types.keys())
 
-    def duck_type_from_pd(dtype) -> str:
-        if pd.api.types.is_integer_dtype(dtype):
-            return "BIGINT"
-        if pd.api.types.is_float_dtype(dtype):
-            return "DOUBLE"
-        if pd.api.types.is_bool_dtype(dtype):
-            return "BOOLEAN"
-        if pd.api.types.is_datetime64_any_dtype(dtype):
-            return "TIMESTAMP"
-        return "VARCHAR"
-
-    for col in [c for c in df.columns if c not in table_cols]:
-        con.execute(
-            f"ALTER TABLE {_norm(table)} ADD COLUMN {col} {duck_type_from_pd(df[col].dtype)}"
-        )
-        table_types[col] = duck_type_from_pd(df[col].dtype)
+    for col in [c for c in df_types if c not in table_cols]:
+        ddl.append(f"ALTER TABLE {tbl} ADD COLUMN {_quote(col)} {col_type(df_types[col])}")
+        if df_types[col] == "NULL":
+            mark_untyped(col)
+            untyped.add(col)
+        table_types[col] = col_type(df_types[col])
         table_cols.append(col)
 
-    def needs_widen(current_duck: str, series: pd.Series):
-        if current_duck in ("VARCHAR", "JSON"):
+    def is_nested(duck_type: str) -> bool:
+        return duck_type.endswith("]") or duck_type.startswith(("STRUCT", "MAP"))
+
+    def needs_widen(current_duck: str, incoming_duck: str):
+        if current_duck == "VARCHAR" or current_duck == incoming_duck:
+            return None
+        if incoming_duck == "NULL":
             return None
-        if series.dtype == object:
+        if current_duck == "JSON":
+            # plain strings such as "-" are not valid JSON
+            return "VARCHAR" if incoming_duck == "VARCHAR" else None
+        if incoming_duck == "VARCHAR":
             return "VARCHAR"
-        if pd.api.types.is_float_dtype(series) and current_duck in (
+        if is_nested(current_duck) or is_nested(incoming_duck):
+            # e.g. a struct that gained a field: keep it all as JSON
+            return "JSON"
+        if incoming_duck in ("FLOAT", "DOUBLE") and current_duck in (
             "TINYINT",
             "SMALLINT",
             "INTEGER",
             "BIGINT",
         ):
             return "DOUBLE"
-        if pd.api.types.is_datetime64_any_dtype(series) and current_duck != "TIMESTAMP":
+        if incoming_duck.startswith("TIMESTAMP") and not current_duck.startswith("TIMESTAMP"):
             return "TIMESTAMP"
         return None
 
-    for col in set(df.columns) & set(table_cols):
-        tgt = needs_widen(table_types[col], df[col])
+    for col in set(df_types) & set(table_cols):
+        if col in untyped:
+            if df_types[col] == "NULL":
+                continue
+            # a placeholder column takes the first real type it sees
+            tgt = None if df_types[col] == "VARCHAR" else df_types[col]
+            ddl.append(f"COMMENT ON COLUMN {tbl}.{_quote(col)} IS NULL")
+        else:
+            tgt = needs_widen(table_types[col], df_types[col])
         if tgt:
-            con.execute(
-                f"ALTER TABLE {_norm(table)} ALTER COLUMN {col} TYPE {tgt}"
-            )
+            # existing nested rows become JSON text, not DuckDB's {'a': 1} literal form
+            using = f" USING to_json({_quote(col)})" if is_nested(table_types[col]) else ""
+            ddl.append(f"ALTER TABLE {tbl} ALTER COLUMN {_quote(col)} TYPE {tgt}{using}")
             table_types[col] = tgt
 
-    select_exprs = [(c if c in df.columns else f"NULL AS {c}") for c in table_cols]
-    con.register("tmp_df", df)
-    con.execute(
-        f"INSERT INTO {_norm(table)} SELECT {', '.join(select_exprs)} FROM tmp_df"
-    )
-    con.unregister("tmp_df")
+    if ddl:
+        con.execute(";\n".join(ddl))
+
+    # nested values bound for string columns go in as JSON, like the rows already there
+    names = set(new_cols)
+    as_json = {
+        c for c in names
+        if is_nested(df_types[c]) and table_types[c] in ("VARCHAR", "JSON")
+    }
+
+    if set(df_types) == set(table_cols) and not as_json:
+        # same column set as the table: insert straight from the Arrow scan
+        con.execute(f"INSERT INTO {tbl} BY NAME SELECT * FROM tmp_arrow")
+    else:
+        # otherwise pad the missing table columns with NULLs
+        select_exprs = []
+        for c in table_cols:
+            if c not in names:
+                select_exprs.append(f"NULL AS {_quote(c)}")
+            elif c in as_json:
+                select_exprs.append(f"to_json({_quote(c)}) AS {_quote(c)}")
+            else:
+                select_exprs.append(_quote(c))
+        con.execute(
+            f"INSERT INTO {tbl} SELECT {', '.join(select_exprs)} FROM tmp_arrow"
+        )
+    con.unregister("tmp_arrow")
 
 # -------------------------
 # MAIN
@@ -200,25 +375,34 @@ def main():
     if not API_KEY:
         raise RuntimeError("Set your API key in env var CBB_API_KEY or edit API_KEY")
 
-    records = fetch_player_stats(SEASON)
-    print(f"Fetched {len(records)} player-season rows for season {SEASON}")
+    total = 0
 
-    if not records:
-        print("No /stats/player/season data returned")
-        return
+    with duckdb.connect(DUCKDB_PATH) as con:
+        con.execute("BEGIN TRANSACTION")
 
-    raw_df = to_raw_df(records)
-    flat_df = to_flat_df(records, sep=".")
+        # parse, transform and append batch by batch so memory stays O(BATCH_SIZE)
+        for batch in batched(fetch_player_stats(SEASON), BATCH_SIZE):
+            flat_df = to_flat_df(batch, sep=".")
+            print("flat_df shape:", flat_df.shape)
+            append_df(con, FLAT_TABLE, flat_df)
 
-    print("raw_df shape:", raw_df.shape)
-    print("flat_df shape:", flat_df.shape)
+            if WRITE_RAW:
+                raw_df = to_raw_df(batch)
+                print("raw_df shape:", raw_df.shape)
+                append_df(con, RAW_TABLE, raw_df)
 
-    with duckdb.connect(DUCKDB_PATH) as con:
-        append_df(con, RAW_TABLE, raw_df)
-        append_df(con, FLAT_TABLE, flat_df)
+            total += len(batch)
+
+        con.execute("COMMIT")
+
+    print(f"Fetched {total} player-season rows for season {SEASON}")
+
+    if not total:
+        print("No /stats/player/season data returned")
+        return
 
     print(f"Done. Wrote player stats to {DUCKDB_PATH}")
-    print(f"Tables: {RAW_TABLE}, {FLAT_TABLE}")
+    print(f"Tables: {', '.join([FLAT_TABLE] + ([RAW_TABLE] if WRITE_RAW else []))}")
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,33 @@
 import duckdb
+import pyarrow as pa
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 # ---------------- CONFIG ----------------
 DB_PATH = "/Users/dominicparolin/Code/dommyhoops/backend/cbb_data.duckdb"
 TABLE   = "plays_team_flat_2025"          # change to your PBP table name
 CHUNK_SIZE = 20_000      # tune chunk size if you want
+PARSE_IN_SQL = True      # False = stream rows through parse_play_text
+PARSE_CHUNKSIZE = 2_000  # rows per task handed to each parser process
+STAGE_ROWS = 500_000     # parsed rows held in memory before staging them
 # ----------------------------------------
 
 
 slug_re = re.compile(r"[^a-z0-9]+")
+foul_on_re = re.compile(r"foul on\s+(.+?)(?:[.:]|$)", re.IGNORECASE)
+foul_on_player_re = re.compile(r"foul_on_player[:\s]+(.+?)(?:[.:]|$)", re.IGNORECASE)
+
+# RE2 class for the characters str.strip() removes (RE2's \s is ASCII-only)
+strip_ws = r"[\s\x{0B}\x{1C}-\x{1F}\x{85}\p{Z}]"
+
+# Generic action verbs ("foul" is the fallback for any other foul text).
+# The earliest match in the text wins; on a tie the alternation order
+# decides, so rebounds work cleanly
+verb_re = re.compile(
+    r" (?:offensive rebound|defensive rebound|made |missed |turnover|blocked |block "
+    r"|substitution|rebound|steal|foul)",
+    re.IGNORECASE,
+)
 
 def snake_case(s: str) -> str:
     s = (s or "").lower()
@@ -32,13 +51,13 @@ def parse_play_text(play_text: str, shooting_play: bool):
         return "", ""
 
     text = play_text.strip()
-    lower = text.lower()
 
     # 1) Shooting plays: force type "shot"
     if shooting_play:
+        lower = text.lower()
         player = ""
 
-        for kw in [" made ", " missed "]:
+        for kw in (" made ", " missed "):
             idx = lower.find(kw)
             if idx != -1:
                 player = text[:idx].strip(" .")
@@ -48,59 +67,161 @@ def parse_play_text(play_text: str, shooting_play: bool):
 
     # 2) Fouls based on 'foul on <player>' in playText
     #    e.g. "Team foul on John Smith", "Foul on John Smith."
-    m = re.search(r"foul on\s+(.+?)(?:[.:]|$)", text, flags=re.IGNORECASE)
+    m = foul_on_re.search(text)
     if m:
         player = m.group(1).strip(" .")
         return "foul", player
 
     # Also handle 'foul_on_player <player>' style if present
-    m = re.search(r"foul_on_player[:\s]+(.+?)(?:[.:]|$)", text, flags=re.IGNORECASE)
+    m = foul_on_player_re.search(text)
     if m:
         player = m.group(1).strip(" .")
         return "foul", player
 
     # 3) Generic action parsing for non-shooting, non-explicit-foul plays
-    # Order matters so rebounds work cleanly
-    verbs = [
-        " offensive rebound",
-        " defensive rebound",
-        " made ",
-        " missed ",
-        " turnover",
-        " blocked ",
-        " block ",
-        " substitution",
-        " rebound",
-        " steal",
-        " foul",    # generic fallback foul text if any
-    ]
-
-    best_idx = None
-    best_verb = None
-
-    for v in verbs:
-        idx = lower.find(v)
-        if idx != -1:
-            if best_idx is None or idx < best_idx:
-                best_idx = idx
-                best_verb = v
-
-    player = ""
-    action = ""
-
-    if best_idx is not None:
+    m = verb_re.search(text)
+
+    if m:
         # Everything before the verb is the player
-        player = text[:best_idx].strip(" .")
+        player = text[:m.start()].strip(" .")
         # Everything from the verb onwards is the action
-        action = text[best_idx:].strip(" .")
+        action = text[m.start():].strip(" .")
     else:
         # Fallback: no recognizable verb, treat the whole thing as action
+        player = ""
         action = text
 
     play_type = snake_case(action)
     return play_type, player
 
 
+def _parse_row(row):
+    """
+    (rowid, playText, shootingPlay) -> (rowid, play_type, player), for worker processes.
+    """
+    rowid, play_text, shooting_play = row
+    play_type, player = parse_play_text(play_text, bool(shooting_play))
+    return rowid, play_type, player
+
+
+def parse_sql(table: str) -> str:
+    """
+    Set-based version of parse_play_text as a single DuckDB UPDATE.
+
+    Reuses the module regexes (RE2 accepts them as written), so the
+    SQL and Python paths agree row for row.
+    """
+    return rf"""
+        UPDATE {table} AS t
+        SET play_type = p.play_type,
+            player    = p.player
+        FROM (
+            SELECT
+                rid,
+                CASE
+                    WHEN is_empty THEN ''
+                    WHEN shooting THEN 'shot'
+                    WHEN foul_on <> '' OR foul_on_player <> '' THEN 'foul'
+                    ELSE trim(regexp_replace(
+                        lower(CASE WHEN verb_action <> '' THEN trim(verb_action, ' .') ELSE txt END),
+                        '{slug_re.pattern}', '_', 'g'
+                    ), '_')
+                END AS play_type,
+                CASE
+                    WHEN is_empty THEN ''
+                    WHEN shooting THEN trim(coalesce(nullif(shot_made, ''), shot_missed), ' .')
+                    WHEN foul_on <> '' THEN trim(foul_on, ' .')
+                    WHEN foul_on_player <> '' THEN trim(foul_on_player, ' .')
+                    ELSE trim(verb_player, ' .')
+                END AS player
+            FROM (
+                SELECT
+                    rid,
+                    is_empty,
+                    shooting,
+                    txt,
+                    regexp_extract(txt, '(?is)^(.*?) made ', 1)                 AS shot_made,
+                    regexp_extract(txt, '(?is)^(.*?) missed ', 1)               AS shot_missed,
+                    regexp_extract(txt, '(?i){foul_on_re.pattern}', 1)          AS foul_on,
+                    regexp_extract(txt, '(?i){foul_on_player_re.pattern}', 1)   AS foul_on_player,
+                    regexp_extract(txt, '(?is)^(.*?){verb_re.pattern}', 1)      AS verb_player,
+                    regexp_extract(txt, '(?is)^.*?({verb_re.pattern}.*)$', 1)   AS verb_action
+                FROM (
+                    SELECT
+                        rowid                                     AS rid,
+                        coalesce(playText, '') = ''               AS is_empty,
+                        coalesce(shootingPlay, false)             AS shooting,
+                        regexp_replace(playText, '^{strip_ws}+|{strip_ws}+$', '', 'g') AS txt
+                    FROM {table}
+                )
+            )
+        ) AS p
+        WHERE t.rowid = p.rid
+    """
+
+
+def update_in_python(con, total_rows: int):
+    # Adjust column names if yours differ
+    cur = con.cursor()
+    cur.execute(
+        f"SELECT rowid, playText, shootingPlay FROM {TABLE}"
+    )
+
+    processed = 0
+    chunk_index = 0
+    rowids, play_types, players = [], [], []
+
+    # Parsed rows are staged in super-batches, then applied in one UPDATE
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE _stage (
+            rid BIGINT,
+            play_type VARCHAR,
+            player VARCHAR
+        )
+    """)
+
+    def stage():
+        updates = pa.table({"rid": rowids, "play_type": play_types, "player": players})
+        con.register("updates", updates)
+        con.execute("INSERT INTO _stage SELECT * FROM updates")
+        con.unregister("updates")
+        rowids.clear()
+        play_types.clear()
+        players.clear()
+
+    # Parsing is pure Python and CPU-bound, so spread it over processes
+    with ProcessPoolExecutor() as ex:
+        while True:
+            rows = cur.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+
+            for rowid, play_type, player in ex.map(_parse_row, rows, chunksize=PARSE_CHUNKSIZE):
+                rowids.append(rowid)
+                play_types.append(play_type)
+                players.append(player)
+
+            if len(rowids) >= STAGE_ROWS:
+                stage()
+
+            processed += len(rows)
+            chunk_index += 1
+            pct = processed * 100.0 / total_rows
+            print(f"Chunk {chunk_index}: {processed:,}/{total_rows:,} rows ({pct:.1f}%)")
+
+    if rowids:
+        stage()
+
+    # Apply everything with one join-update instead of a lookup per row
+    con.execute(f"""
+        UPDATE {TABLE} AS t
+        SET play_type = s.play_type, player = s.player
+        FROM _stage AS s
+        WHERE t.rowid = s.rid
+    """)
+    con.execute("DROP TABLE _stage")
+
+
 def main():
     con = duckdb.connect(DB_PATH)
 
@@ -122,40 +243,15 @@ def main():
 
     print(f"Updating {total_rows:,} rows in {TABLE}...")
 
-    # 3) Stream rows and update in chunks in a single transaction
+    # 3) Parse and update everything in a single transaction
     con.execute("BEGIN TRANSACTION")
 
-    # Adjust column names if yours differ
-    cur = con.cursor()
-    cur.execute(
-        f"SELECT rowid, playText, shootingPlay FROM {TABLE}"
-    )
-
-    processed = 0
-    chunk_index = 0
-
-    while True:
-        rows = cur.fetchmany(CHUNK_SIZE)
-        if not rows:
-            break
-
-        updates = []
-        for rowid, play_text, shooting_play in rows:
-            play_type, player = parse_play_text(
-                play_text,
-                bool(shooting_play),
-            )
-            updates.append((play_type, player, rowid))
-
-        con.executemany(
-            f"UPDATE {TABLE} SET play_type = ?, player = ? WHERE rowid = ?",
-            updates,
-        )
-
-        processed += len(rows)
-        chunk_index += 1
-        pct = processed * 100.0 / total_rows
-        print(f"Chunk {chunk_index}: {processed:,}/{total_rows:,} rows ({pct:.1f}%)")
+    if PARSE_IN_SQL:
+        # One set-based UPDATE; DuckDB runs the regexes vectorized
+        con.execute(parse_sql(TABLE))
+    else:
+        # Stream rows through parse_play_text and update in chunks
+        update_in_python(con, total_rows)
 
     con.execute("COMMIT")
     con.close()
@@ -165,4 +261,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-